@@ -1,16 +1,16 @@
 import os
 import logging
-import threading
 import time
-import traceback
 import asyncio
-import html
+import io
+import hmac
 import secrets
-import string
 import random
+import signal
 import aiohttp
 import re
-from flask import Flask
+from collections import deque
+from aiohttp import web
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
     Application,
@@ -19,12 +19,22 @@ from telegram.ext import (
     filters,
     ContextTypes,
     ApplicationBuilder,
-    CallbackQueryHandler
+    CallbackQueryHandler,
+    TypeHandler
 )
-from telegram.error import RetryAfter, BadRequest
-from motor.motor_asyncio import AsyncIOMotorClient
-from datetime import datetime, timedelta
-import concurrent.futures
+from telegram.error import RetryAfter
+from telegram.request import HTTPXRequest
+from cachetools import TTLCache
+from pymongo import AsyncMongoClient, IndexModel, UpdateOne
+from pymongo.errors import OperationFailure
+from datetime import datetime, timedelta, timezone
+import functools
+
+# orjson parses in C; fall back to stdlib json when it is not installed
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 # Configure logging
 logging.basicConfig(
@@ -34,41 +44,219 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Global variables
-bot_start_time = time.time()
+bot_start_time = time.monotonic()  # uptime survives wall-clock jumps
 BOT_VERSION = "8.2"  # Premium plans version
-temp_params = {}
 DB = None  # Global async database instance
 MONGO_CLIENT = None  # Global MongoDB client
 SESSION = None  # Global aiohttp session
 
+# Owner id parsed once; ids stay int end-to-end (Telegram ids are always > 0,
+# so 0 safely rejects everyone when the env var is unset)
+OWNER_ID = int(os.getenv('OWNER_ID', '0'))
+BOT_USERNAME = os.getenv('BOT_USERNAME')  # falls back to context.bot.username
+TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
+MONGO_URI = os.getenv('MONGO_URI')
+PORT = int(os.getenv('PORT', '8000'))
+# Public base URL for webhook mode; unset means long polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+
 # API Configuration
 AD_API = os.getenv('AD_API', '446b3a3f0039a2826f1483f22e9080963974ad3b')
 WEBSITE_URL = os.getenv('WEBSITE_URL', 'upshrink.com')
 YOUTUBE_TUTORIAL = "https://youtu.be/WeqpaV6VnO4?si=Y0pDondqe-nmIuht"
 GITHUB_REPO = "https://github.com/yourusername/your-repo"
 PREMIUM_CONTACT = "@Mr_rahul090"  # Premium contact
+PREMIUM_CONTACT_USERNAME = PREMIUM_CONTACT.lstrip('@')  # for t.me links
+
+# Durations accepted by /addpremium
+DURATION_MAP = {
+    "1hr": timedelta(hours=1),
+    "1day": timedelta(days=1),
+    "1month": timedelta(days=30),
+    "1year": timedelta(days=365)
+}
+
+# Static keyboard shared by /start and /help, built once at import
+TUTORIAL_KEYBOARD = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🎥 Watch Tutorial", url=YOUTUBE_TUTORIAL),
+        InlineKeyboardButton("💎 Premium Plans", callback_data="premium_plans")
+    ]
+])
+
+# Welcome text variants, built once at import
+_WELCOME_BASE = (
+    "🌟 *Welcome to Quiz Bot!* 🌟\n\n"
+    "I can turn your text files into interactive 10-second quizzes!\n\n"
+    "🔹 Use /createquiz - Start quiz creation\n"
+    "🔹 Use /help - Show formatting guide\n"
+    "🔹 Use /token - Get your access token\n"
+    "🔹 Premium users get unlimited access!\n\n"
+)
+WELCOME_PRIVILEGED = _WELCOME_BASE + "Let's make learning fun!"
+WELCOME_STANDARD = _WELCOME_BASE + (
+    "🔒 You need premium or a token to access all features\n"
+    "Get your access token with /token - Valid for 24 hours\n\n"
+    "Let's make learning fun!"
+)
+
+# Static help text, built once at import
+HELP_TEXT = (
+    "📝 *Quiz File Format Guide:*\n\n"
+    "```\n"
+    "What is 2+2?\n"
+    "A) 3\n"
+    "B) 4\n"
+    "C) 5\n"
+    "D) 6\n"
+    "Answer: 2\n"
+    "The correct answer is 4\n\n"
+    "Python is a...\n"
+    "A. Snake\n"
+    "B. Programming language\n"
+    "C. Coffee brand\n"
+    "D. Movie\n"
+    "Answer: 2\n"
+    "```\n\n"
+    "📌 *Rules:*\n"
+    "• One question per block (separated by blank lines)\n"
+    "• Exactly 4 options (any prefix format accepted)\n"
+    "• Answer format: 'Answer: <1-4>' (1=first option, 2=second, etc.)\n"
+    "• Optional 7th line for explanation (any text)\n\n"
+    "💡 *Premium Benefits:*\n"
+    "- Unlimited quiz creation\n"
+    "- No token required\n"
+    "- Priority support"
+)
+
+PLAN_TEXT = (
+    "<b>💠 UPGRADE TO PREMIUM 💠</b>\n\n"
+    "<b>🚀 Premium Features:</b>\n"
+    "🧠 UNLIMITED QUIZ CREATION\n\n"
+
+    "<b>🔓 FREE PLAN</b> (with restrictions)\n"
+    "🕰️ <b>Expiry:</b> Never\n"
+    "💰 <b>Price:</b> ₹0\n\n"
+
+    "<b>🕐 1-DAY PLAN</b>\n"
+    "💰 <b>Price:</b> ₹10 🇮🇳\n"
+    "📅 <b>Duration:</b> 1 Day\n\n"
+
+    "<b>📆 1-WEEK PLAN</b>\n"
+    "💰 <b>Price:</b> ₹25 🇮🇳\n"
+    "📅 <b>Duration:</b> 10 Days\n\n"
+
+    "<b>🗓️ MONTHLY PLAN</b>\n"
+    "💰 <b>Price:</b> ₹50 🇮🇳\n"
+    "📅 <b>Duration:</b> 1 Month\n\n"
+
+    "<b>🪙 2-MONTH PLAN</b>\n"
+    "💰 <b>Price:</b> ₹100 🇮🇳\n"
+    "📅 <b>Duration:</b> 2 Months\n\n"
+
+    f"📞 <b>Contact Now to Upgrade</b>\n👉 {PREMIUM_CONTACT}"
+)
+
+PLAN_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💎 Get Premium", url=f"https://t.me/{PREMIUM_CONTACT_USERNAME}")],
+    [InlineKeyboardButton("📋 My Plan", callback_data="my_plan")]
+])
+
+CREATE_QUIZ_TEXT = (
+    "📤 *Ready to create your quiz!*\n\n"
+    "Please send me a .txt file containing your questions.\n\n"
+    "Need format help? Use /help"
+)
+
+# Per-request .format templates; the constant literals are built once
+MY_PLAN_TEMPLATE = (
+    "⚜️ ᴘʀᴇᴍɪᴜᴍ ᴜꜱᴇʀ ᴅᴀᴛᴀ :\n\n"
+    "👤 ᴜꜱᴇʀ : {full_name}\n"
+    "⚡ ᴜꜱᴇʀ ɪᴅ : `{user_id}`\n"
+    "⏰ ᴘʀᴇᴍɪᴜᴍ ᴘʟᴀɴ : {plan_name}\n\n"
+    "⏱️ ᴊᴏɪɴɪɴɢ ᴅᴀᴛᴇ : {start_date} IST\n"
+    "⌛️ ᴇxᴘɪʀʏ ᴅᴀᴛᴇ : {expiry_date} IST\n"
+    "⏳ ᴛɪᴍᴇ ʟᴇꜰᴛ : {time_left}"
+)
 
-# Caches for performance
-SUDO_CACHE = {}
-TOKEN_CACHE = {}
-PREMIUM_CACHE = {}
+PREMIUM_ENTRY_TEMPLATE = (
+    "👤 *User*: {full_name}\n"
+    "🆔 *ID*: `{user_id}`\n"
+    "📦 *Plan*: {plan}\n"
+    "⏱️ *Start*: {start_date} IST\n"
+    "⏳ *Expiry*: {expiry_date} IST\n"
+    "────────────────────"
+)
+
+# Callback data accepted by button_handler, precompiled so PTB skips
+# its own compile and unknown callbacks never reach the handler
+BUTTON_CB_PATTERN = re.compile(r"^(premium_plans|my_plan)$")
+
+# Caches for performance; TTLCache bounds memory and evicts expired
+# entries itself, so values are plain bools (negative results included)
 CACHE_EXPIRY = 60  # seconds
+SUDO_CACHE = TTLCache(maxsize=100_000, ttl=CACHE_EXPIRY)
+TOKEN_CACHE = TTLCache(maxsize=100_000, ttl=CACHE_EXPIRY)
+PREMIUM_CACHE = TTLCache(maxsize=100_000, ttl=CACHE_EXPIRY)
+# Username -> (user_id, full name); usernames change rarely, so a long
+# TTL spares the admin commands a COLLSCAN-prone lookup
+USERNAME_CACHE = TTLCache(maxsize=10_000, ttl=3600)
+# Rendered /myplan replies; a rapid button re-click serves the same text
+# without re-querying Mongo or re-rendering
+PLAN_RENDER_CACHE = TTLCache(maxsize=10_000, ttl=15)
+
+# Per-user locks so concurrent cache misses collapse into one DB query.
+# Bounded like the caches they guard; a lock evicted by the TTL only
+# costs one duplicate query on the next stampede
+SUDO_LOCKS = TTLCache(maxsize=100_000, ttl=CACHE_EXPIRY)
+TOKEN_LOCKS = TTLCache(maxsize=100_000, ttl=CACHE_EXPIRY)
+PREMIUM_LOCKS = TTLCache(maxsize=100_000, ttl=CACHE_EXPIRY)
+
+def get_user_lock(locks, user_id):
+    lock = locks.get(user_id)
+    if lock is None:
+        lock = locks.setdefault(user_id, asyncio.Lock())
+    return lock
 
 # Broadcast state
 BROADCAST_STATE = {}
+BROADCAST_CONCURRENCY = int(os.getenv('BROADCAST_CONCURRENCY', '30'))
+
+# Progress template formatted once per throttled edit
+BROADCAST_PROGRESS_TEMPLATE = (
+    "📤 Broadcasting to {total} users...\n"
+    "Sent: {sent} | Failed: {failed}"
+)
+
+# Captioned media kinds accepted for broadcast: (attribute, file_id getter)
+BROADCAST_MEDIA_KINDS = (
+    ("photo", lambda m: m.photo[-1].file_id),  # Highest resolution
+    ("video", lambda m: m.video.file_id),
+    ("document", lambda m: m.document.file_id),
+)
 
-# Flask app for health checks
-app = Flask(__name__)
+# Pending user-interaction writes, coalesced by the background flusher
+PENDING_USER_WRITES = {}
+FLUSH_INTERVAL = 2  # seconds
 
-@app.route('/')
-@app.route('/health')
-@app.route('/status')
-def health_check():
-    return "Bot is running", 200
+# Signatures of recently-written users; suppresses redundant upserts from
+# chatty users whose profile fields have not changed
+RECENT_USERS = TTLCache(maxsize=50_000, ttl=60)
 
-def run_flask():
-    port = int(os.environ.get('PORT', 8000))
-    app.run(host='0.0.0.0', port=port, threaded=True)
+# Health-check endpoint served from the bot's own event loop
+async def health_check(request):
+    return web.Response(text="Bot is running")
+
+async def start_health_server():
+    health_app = web.Application()
+    health_app.router.add_get('/', health_check)
+    health_app.router.add_get('/health', health_check)
+    health_app.router.add_get('/status', health_check)
+    runner = web.AppRunner(health_app)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', PORT).start()
+    logger.info(f"Health server listening on port {PORT}")
+    return runner
 
 # Convert UTC to IST (UTC+5:30)
 def to_ist(utc_time):
@@ -81,36 +269,41 @@ def format_ist(utc_time):
 
 # Format time left
 def format_time_left(expiry):
-    now = datetime.utcnow()
-    if expiry < now:
+    total = int((expiry - datetime.utcnow()).total_seconds())
+    if total <= 0:
         return "Expired"
-    
-    delta = expiry - now
-    days = delta.days
-    seconds = delta.seconds
-    hours = seconds // 3600
-    minutes = (seconds % 3600) // 60
-    
-    parts = []
-    if days > 0:
-        parts.append(f"{days} days")
-    if hours > 0:
-        parts.append(f"{hours} hours")
-    if minutes > 0:
-        parts.append(f"{minutes} minutes")
-    
+
+    days, rest = divmod(total, 86400)
+    hours, rest = divmod(rest, 3600)
+    minutes = rest // 60
+
+    parts = [
+        f"{value} {unit}"
+        for value, unit in ((days, "days"), (hours, "hours"), (minutes, "minutes"))
+        if value > 0
+    ]
     return ", ".join(parts) if parts else "Less than 1 minute"
 
 # Async MongoDB connection
 async def init_db():
     global DB, MONGO_CLIENT
     try:
-        mongo_uri = os.getenv('MONGO_URI')
-        if not mongo_uri:
+        if not MONGO_URI:
             logger.error("MONGO_URI environment variable not set")
             return None
-            
-        MONGO_CLIENT = AsyncIOMotorClient(mongo_uri, maxPoolSize=100, minPoolSize=10)
+
+        MONGO_CLIENT = AsyncMongoClient(
+            MONGO_URI,
+            maxPoolSize=200,
+            minPoolSize=10,
+            maxIdleTimeMS=300_000,
+            waitQueueTimeoutMS=5000,
+            serverSelectionTimeoutMS=3000,
+            retryWrites=True,
+            # zstandard ships as a pure wheel and is pinned in
+            # requirements, so zstd actually negotiates
+            compressors="zstd"
+        )
         DB = MONGO_CLIENT.get_database("telegram_bot")
         await DB.command('ping')  # Test connection
         logger.info("MongoDB connection successful")
@@ -119,33 +312,54 @@ async def init_db():
         logger.error(f"MongoDB connection error: {e}")
         return None
 
-# Create TTL index for token expiration
-async def create_ttl_index():
-    try:
-        if DB is not None:
-            await DB.tokens.create_index("expires_at", expireAfterSeconds=0)
-            logger.info("Created TTL index for token expiration")
-    except Exception as e:
-        logger.error(f"Error creating TTL index: {e}")
+# Create all indexes at startup: one createIndexes round trip per
+# collection, collections in parallel; idempotent on every boot
+async def create_db_indexes():
+    if DB is None:
+        return
+    collections = [
+        (DB.tokens, [
+            IndexModel("expires_at", expireAfterSeconds=0),
+            # Unique: each user holds at most one token, and the covered
+            # validity probe only touches user_id since the TTL index
+            # took over expiry
+            IndexModel("user_id", unique=True)
+        ]),
+        (DB.sudo_users, [
+            IndexModel("user_id", unique=True)
+        ]),
+        (DB.premium_users, [
+            IndexModel("user_id", unique=True),
+            # TTL: Mongo purges expired premium docs itself
+            IndexModel("expiry_date", expireAfterSeconds=0)
+        ]),
+        (DB.users, [
+            IndexModel("user_id", unique=True),
+            IndexModel("username")
+        ])
+    ]
 
-# Create index for sudo users
-async def create_sudo_index():
-    try:
-        if DB is not None:
-            await DB.sudo_users.create_index("user_id", unique=True)
-            logger.info("Created index for sudo_users")
-    except Exception as e:
-        logger.error(f"Error creating sudo index: {e}")
+    async def create_for(collection, models):
+        try:
+            await collection.create_indexes(models)
+        except OperationFailure:
+            # An existing index with the same keys but different options
+            # (e.g. expiry_date from before it became a TTL index) blocks
+            # creation; drop the stale definitions and retry once
+            for model in models:
+                try:
+                    await collection.drop_index(model.document["name"])
+                except Exception:
+                    pass
+            try:
+                await collection.create_indexes(models)
+            except Exception as e:
+                logger.error(f"Error creating {collection.name} indexes: {e}")
+        except Exception as e:
+            logger.error(f"Error creating {collection.name} indexes: {e}")
 
-# Create index for premium users
-async def create_premium_index():
-    try:
-        if DB is not None:
-            await DB.premium_users.create_index("user_id", unique=True)
-            await DB.premium_users.create_index("expiry_date")
-            logger.info("Created index for premium_users")
-    except Exception as e:
-        logger.error(f"Error creating premium index: {e}")
+    await asyncio.gather(*(create_for(c, m) for c, m in collections))
+    logger.info("Database indexes ensured")
 
 # Optimized user interaction recording
 async def record_user_interaction(update: Update):
@@ -153,76 +367,207 @@ async def record_user_interaction(update: Update):
         # Check if DB is initialized (not None)
         if DB is None:
             return
-            
+
         user = update.effective_user
         if not user:
             return
-            
-        # Use update with upsert
-        await DB.users.update_one(
+
+        # Skip the write entirely if this user was persisted recently
+        # with the same profile fields
+        sig = (user.first_name, user.last_name, user.username)
+        if RECENT_USERS.get(user.id) == sig:
+            return
+        RECENT_USERS[user.id] = sig
+
+        # Queue the upsert; the background flusher batches these into
+        # one bulk_write instead of a round-trip per update
+        PENDING_USER_WRITES[user.id] = UpdateOne(
             {"user_id": user.id},
             {"$set": {
                 "first_name": user.first_name,
                 "last_name": user.last_name,
-                "username": user.username,
-                "last_interaction": datetime.utcnow()
-            }},
+                "username": user.username
+            },
+             # Let Mongo stamp the timestamp server-side; avoids client
+             # clock skew and a datetime per queued write
+             "$currentDate": {"last_interaction": True}},
             upsert=True
         )
     except Exception as e:
         logger.error(f"Error saving user data: {e}")
 
-# Generate a random parameter
-def generate_random_param(length=8):
-    alphabet = string.ascii_letters + string.digits
-    return ''.join(secrets.choice(alphabet) for _ in range(length))
+# Flush queued user writes in a single bulk operation
+async def flush_user_writes():
+    if DB is None or not PENDING_USER_WRITES:
+        return
+    ops = list(PENDING_USER_WRITES.values())
+    PENDING_USER_WRITES.clear()
+    try:
+        await DB.users.bulk_write(ops, ordered=False)
+    except Exception as e:
+        logger.error(f"Error flushing user data: {e}")
 
-# Optimized URL shortening with connection pooling
-async def get_shortened_url(deep_link):
-    global SESSION
+# Track the newest update_id seen so the polling offset survives a
+# restart; persisted by the flush loop, restored before polling starts
+LAST_UPDATE_ID = None
+_PERSISTED_UPDATE_ID = None
+
+async def track_update_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    global LAST_UPDATE_ID
+    LAST_UPDATE_ID = update.update_id
+
+async def persist_update_offset():
+    global _PERSISTED_UPDATE_ID
+    if DB is None or LAST_UPDATE_ID is None or LAST_UPDATE_ID == _PERSISTED_UPDATE_ID:
+        return
     try:
-        if SESSION is None:
-            SESSION = aiohttp.ClientSession()
-            
-        api_url = f"https://{WEBSITE_URL}/api?api={AD_API}&url={deep_link}"
-        async with SESSION.get(api_url, timeout=5) as response:
-            if response.status == 200:
-                data = await response.json()
-                if data.get("status") == "success":
-                    return data.get("shortenedUrl")
-        return None
-    except asyncio.TimeoutError:
-        logger.warning("URL shortening timed out")
-        return None
+        await DB.meta.update_one(
+            {"_id": "polling_offset"},
+            {"$set": {"update_id": LAST_UPDATE_ID}},
+            upsert=True
+        )
+        _PERSISTED_UPDATE_ID = LAST_UPDATE_ID
     except Exception as e:
-        logger.error(f"URL shortening failed: {e}")
+        logger.error(f"Error persisting update offset: {e}")
+
+# Snapshot of sudo user ids; there are only ever a handful, so a plain
+# set lets is_sudo reject the overwhelmingly common non-sudo case
+# without touching the cache or DB
+SUDO_IDS = None
+
+async def refresh_sudo_ids():
+    global SUDO_IDS
+    if DB is None:
+        return
+    try:
+        ids = set()
+        async for doc in DB.sudo_users.find({}, {"user_id": 1, "_id": 0}):
+            ids.add(doc["user_id"])
+        SUDO_IDS = ids
+    except Exception as e:
+        logger.error(f"Error refreshing sudo snapshot: {e}")
+
+# Background flusher started from main_async; also refreshes the sudo
+# snapshot once per cache-expiry window
+async def flush_loop():
+    elapsed = 0
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+        await flush_user_writes()
+        await persist_update_offset()
+        elapsed += FLUSH_INTERVAL
+        if elapsed >= CACHE_EXPIRY:
+            elapsed = 0
+            await refresh_sudo_ids()
+
+# Stateless verification params: an HMAC over the user id and the current
+# 5-minute window, so there is no server-side state per pending token and
+# a param minted for one user cannot activate another
+TOKEN_SECRET = (os.getenv('TOKEN_SECRET') or secrets.token_hex(32)).encode()
+VERIFY_WINDOW = 300  # seconds each param stays valid
+
+def make_verification_param(user_id, offset=0):
+    window = int(time.time() // VERIFY_WINDOW) - offset
+    msg = f"{user_id}:{window}".encode()
+    return hmac.new(TOKEN_SECRET, msg, 'sha256').hexdigest()[:16]
+
+def verify_param(user_id, token):
+    # Accept the current and previous window so a param minted just before
+    # a rollover still verifies
+    return any(
+        hmac.compare_digest(make_verification_param(user_id, offset), token)
+        for offset in (0, 1)
+    )
+
+# Create the shared HTTP session with a tuned connector; must run inside
+# the event loop, so main_async calls this at startup
+def init_session():
+    global SESSION
+    SESSION = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=100,
+            ttl_dns_cache=300,
+            keepalive_timeout=75,
+            enable_cleanup_closed=True
+        ),
+        timeout=aiohttp.ClientTimeout(total=5)
+    )
+
+# Circuit breaker for the URL shortener: after enough consecutive
+# failures the API is skipped for a cooldown instead of stalling /token
+SHORTENER_FAILURE_LIMIT = 5
+SHORTENER_COOLDOWN = 30  # seconds
+_shortener_failures = 0
+_shortener_open_until = 0.0
+
+# Optimized URL shortening with retries and fail-fast circuit breaker
+async def get_shortened_url(deep_link):
+    global _shortener_failures, _shortener_open_until
+
+    # Circuit open: fail fast without touching the network
+    if time.monotonic() < _shortener_open_until:
         return None
 
+    api_url = f"https://{WEBSITE_URL}/api?api={AD_API}&url={deep_link}"
+    timeout = aiohttp.ClientTimeout(total=3, sock_connect=1)
+
+    for attempt in range(3):
+        if attempt:
+            # Exponential backoff with jitter between retries
+            await asyncio.sleep(0.5 * (2 ** (attempt - 1)) * (1 + random.random()))
+        try:
+            async with SESSION.get(api_url, timeout=timeout) as response:
+                if response.status == 200:
+                    data = json_loads(await response.read())
+                    if data.get("status") == "success":
+                        _shortener_failures = 0
+                        return data.get("shortenedUrl")
+        except asyncio.TimeoutError:
+            logger.warning("URL shortening timed out")
+        except Exception as e:
+            logger.error(f"URL shortening failed: {e}")
+
+    _shortener_failures += 1
+    if _shortener_failures >= SHORTENER_FAILURE_LIMIT:
+        _shortener_failures = 0
+        _shortener_open_until = time.monotonic() + SHORTENER_COOLDOWN
+        logger.warning(f"URL shortener circuit opened for {SHORTENER_COOLDOWN}s")
+    return None
+
 # Optimized sudo check with caching
 async def is_sudo(user_id):
+    # Fast negative path: almost no one is a sudoer, and the snapshot
+    # answers that without a cache entry or DB round trip
+    if SUDO_IDS is not None and user_id not in SUDO_IDS and user_id != OWNER_ID:
+        return False
+
     # Check cache first
     cached = SUDO_CACHE.get(user_id)
-    if cached and time.time() < cached['expiry']:
-        return cached['result']
-        
-    owner_id = os.getenv('OWNER_ID')
-    if owner_id and str(user_id) == owner_id:
-        result = True
-    else:
-        result = False
-        # Check if DB is initialized (not None)
-        if DB is not None:
-            try:
-                result = await DB.sudo_users.find_one({"user_id": user_id}) is not None
-            except Exception as e:
-                logger.error(f"Sudo check error: {e}")
-    
-    # Update cache
-    SUDO_CACHE[user_id] = {
-        'result': result,
-        'expiry': time.time() + CACHE_EXPIRY
-    }
-    return result
+    if cached is not None:
+        return cached
+
+    async with get_user_lock(SUDO_LOCKS, user_id):
+        # Re-check: another coroutine may have filled the cache while we waited
+        cached = SUDO_CACHE.get(user_id)
+        if cached is not None:
+            return cached
+
+        if OWNER_ID and user_id == OWNER_ID:
+            result = True
+        else:
+            result = False
+            # Check if DB is initialized (not None)
+            if DB is not None:
+                try:
+                    result = await DB.sudo_users.find_one(
+                        {"user_id": user_id}, {"_id": 1}
+                    ) is not None
+                except Exception as e:
+                    logger.error(f"Sudo check error: {e}")
+
+        # Update cache
+        SUDO_CACHE[user_id] = result
+        return result
 
 # Premium token command
 async def token_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -247,11 +592,10 @@ async def token_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         return
     
     # Generate new verification param
-    param = generate_random_param()
-    temp_params[user_id] = param
-    
+    param = make_verification_param(user_id)
+
     # Create deep link
-    bot_username = os.getenv('BOT_USERNAME', context.bot.username)
+    bot_username = BOT_USERNAME or context.bot.username
     deep_link = f"https://t.me/{bot_username}?start={param}"
     
     # Get shortened URL
@@ -288,17 +632,24 @@ async def token_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         reply_markup=reply_markup
     )
 
-# Token verification helper
-async def check_access(update: Update, context: ContextTypes.DEFAULT_TYPE, handler):
-    user_id = update.effective_user.id
-    if await is_sudo(user_id) or await is_premium(user_id) or await has_valid_token(user_id):
-        return await handler(update, context)
-    
-    await update.message.reply_text(
-        "🔒 Access restricted! You need premium or a valid token to use this feature.\n\n"
-        "Use /token to get your access token or contact us for premium.",
-        parse_mode='Markdown'
-    )
+# Access gate for token-protected handlers; the owner skips every lookup
+def gated(handler):
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        user_id = update.effective_user.id
+        # has_valid_token already overlaps the sudo and premium lookups
+        # with asyncio.gather, so one call covers all three checks in a
+        # single parallel round
+        if user_id == OWNER_ID or await has_valid_token(user_id):
+            await handler(update, context)
+            return
+
+        await update.message.reply_text(
+            "🔒 Access restricted! You need premium or a valid token to use this feature.\n\n"
+            "Use /token to get your access token or contact us for premium.",
+            parse_mode='Markdown'
+        )
+    return wrapper
 
 # Wrapper functions for access verification
 async def start_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -308,22 +659,21 @@ async def start_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
         user = update.effective_user
         user_id = user.id
         
-        # Check if it's a verification token
-        if user_id in temp_params and temp_params[user_id] == token:
+        # Recompute the HMAC instead of looking up stored state
+        if verify_param(user_id, token):
             # Store token in database - check if DB is initialized (not None)
             if DB is not None:
+                now = datetime.utcnow()
                 await DB.tokens.update_one(
                     {"user_id": user_id},
                     {"$set": {
                         "token": token,
-                        "created_at": datetime.utcnow(),
-                        "expires_at": datetime.utcnow() + timedelta(hours=24)
+                        "created_at": now,
+                        "expires_at": now + timedelta(hours=24)
                     }},
                     upsert=True
                 )
             
-            # Remove temp param and notify user
-            del temp_params[user_id]
             await update.message.reply_text(
                 "✅ Token activated successfully! Enjoy your 24-hour access.",
                 parse_mode='Markdown'
@@ -338,187 +688,108 @@ async def start_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     # Skip token check for the start command itself
     await start(update, context)
 
-async def help_command_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await check_access(update, context, help_command)
-
-async def create_quiz_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await check_access(update, context, create_quiz)
-
-async def stats_command_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await check_access(update, context, stats_command)
-
-async def handle_document_wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    await check_access(update, context, handle_document)
+# Gate a handler on the DB connection so the body can assume DB is usable
+def requires_db(message):
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+            if DB is None:
+                await update.message.reply_text(message)
+                return
+            await handler(update, context)
+        return wrapper
+    return decorator
 
 # Original command handlers
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await record_user_interaction(update)
-    welcome_msg = (
-        "🌟 *Welcome to Quiz Bot!* 🌟\n\n"
-        "I can turn your text files into interactive 10-second quizzes!\n\n"
-        "🔹 Use /createquiz - Start quiz creation\n"
-        "🔹 Use /help - Show formatting guide\n"
-        "🔹 Use /token - Get your access token\n"
-        "🔹 Premium users get unlimited access!\n\n"
-    )
-    
-    # Add token status for non-premium users
-    if not (await is_sudo(update.effective_user.id) or await is_premium(update.effective_user.id)):
-        welcome_msg += (
-            "🔒 You need premium or a token to access all features\n"
-            "Get your access token with /token - Valid for 24 hours\n\n"
-        )
-    
-    welcome_msg += "Let's make learning fun!"
-    
-    # Create keyboard with tutorial and premium buttons
-    keyboard = [
-        [
-            InlineKeyboardButton("🎥 Watch Tutorial", url=YOUTUBE_TUTORIAL),
-            InlineKeyboardButton("💎 Premium Plans", callback_data="premium_plans")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
+
+    # Token status is only shown to non-premium users
+    if await is_sudo(update.effective_user.id) or await is_premium(update.effective_user.id):
+        welcome_msg = WELCOME_PRIVILEGED
+    else:
+        welcome_msg = WELCOME_STANDARD
+
     await update.message.reply_text(
-        welcome_msg, 
+        welcome_msg,
         parse_mode='Markdown',
-        reply_markup=reply_markup
+        reply_markup=TUTORIAL_KEYBOARD
     )
 
+@gated
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await record_user_interaction(update)
-    keyboard = [
-        [
-            InlineKeyboardButton("🎥 Watch Tutorial", url=YOUTUBE_TUTORIAL),
-            InlineKeyboardButton("💎 Premium Plans", callback_data="premium_plans")
-        ]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await update.message.reply_text(
-        "📝 *Quiz File Format Guide:*\n\n"
-        "```\n"
-        "What is 2+2?\n"
-        "A) 3\n"
-        "B) 4\n"
-        "C) 5\n"
-        "D) 6\n"
-        "Answer: 2\n"
-        "The correct answer is 4\n\n"
-        "Python is a...\n"
-        "A. Snake\n"
-        "B. Programming language\n"
-        "C. Coffee brand\n"
-        "D. Movie\n"
-        "Answer: 2\n"
-        "```\n\n"
-        "📌 *Rules:*\n"
-        "• One question per block (separated by blank lines)\n"
-        "• Exactly 4 options (any prefix format accepted)\n"
-        "• Answer format: 'Answer: <1-4>' (1=first option, 2=second, etc.)\n"
-        "• Optional 7th line for explanation (any text)\n\n"
-        "💡 *Premium Benefits:*\n"
-        "- Unlimited quiz creation\n"
-        "- No token required\n"
-        "- Priority support",
+        HELP_TEXT,
         parse_mode='Markdown',
-        reply_markup=reply_markup
+        reply_markup=TUTORIAL_KEYBOARD
     )
 
 async def plan_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await record_user_interaction(update)
-    
-    # Create premium plans message with HTML formatting
-    plans_message = (
-        "<b>💠 UPGRADE TO PREMIUM 💠</b>\n\n"
-        "<b>🚀 Premium Features:</b>\n"
-        "🧠 UNLIMITED QUIZ CREATION\n\n"
-        
-        "<b>🔓 FREE PLAN</b> (with restrictions)\n"
-        "🕰️ <b>Expiry:</b> Never\n"
-        "💰 <b>Price:</b> ₹0\n\n"
-        
-        "<b>🕐 1-DAY PLAN</b>\n"
-        "💰 <b>Price:</b> ₹10 🇮🇳\n"
-        "📅 <b>Duration:</b> 1 Day\n\n"
-        
-        "<b>📆 1-WEEK PLAN</b>\n"
-        "💰 <b>Price:</b> ₹25 🇮🇳\n"
-        "📅 <b>Duration:</b> 10 Days\n\n"
-        
-        "<b>🗓️ MONTHLY PLAN</b>\n"
-        "💰 <b>Price:</b> ₹50 🇮🇳\n"
-        "📅 <b>Duration:</b> 1 Month\n\n"
-        
-        "<b>🪙 2-MONTH PLAN</b>\n"
-        "💰 <b>Price:</b> ₹100 🇮🇳\n"
-        "📅 <b>Duration:</b> 2 Months\n\n"
-        
-        f"📞 <b>Contact Now to Upgrade</b>\n👉 {PREMIUM_CONTACT}"
-    )
-    
-    keyboard = [
-        [InlineKeyboardButton("💎 Get Premium", url=f"https://t.me/{PREMIUM_CONTACT.lstrip('@')}")],
-        [InlineKeyboardButton("📋 My Plan", callback_data="my_plan")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
     await update.message.reply_text(
-        plans_message,
+        PLAN_TEXT,
         parse_mode='HTML',
-        reply_markup=reply_markup
+        reply_markup=PLAN_KEYBOARD
     )
 
+@gated
 async def create_quiz(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await record_user_interaction(update)
     await update.message.reply_text(
-        "📤 *Ready to create your quiz!*\n\n"
-        "Please send me a .txt file containing your questions.\n\n"
-        "Need format help? Use /help",
+        CREATE_QUIZ_TEXT,
         parse_mode='Markdown'
     )
 
+# One compiled match per question block: question, 4 options, answer line,
+# optional explanation. [ \t] instead of \s keeps the pattern newline-safe.
+QUIZ_BLOCK_RE = re.compile(
+    r'^[ \t]*(?P<question>[^\n]+?)[ \t]*\n'
+    r'[ \t]*(?P<o1>[^\n]+?)[ \t]*\n'
+    r'[ \t]*(?P<o2>[^\n]+?)[ \t]*\n'
+    r'[ \t]*(?P<o3>[^\n]+?)[ \t]*\n'
+    r'[ \t]*(?P<o4>[^\n]+?)[ \t]*\n'
+    r'[ \t]*answer[ \t]*:[ \t]*(?P<answer>\d+)[ \t]*'
+    r'(?:\n[ \t]*(?P<explanation>[^\n]+?)[ \t]*)?[ \t\n]*$',
+    re.IGNORECASE
+)
+
 def parse_quiz_file(content: str) -> tuple:
     """Optimized quiz parser"""
-    blocks = content.split('\n\n')
     valid_questions = []
     errors = []
-    
-    for i, block in enumerate(blocks, 1):
+
+    for i, block in enumerate(content.split('\n\n'), 1):
         if not block.strip():
             continue
-            
-        lines = block.split('\n')
-        # Fast validation
-        if len(lines) < 6 or len(lines) > 7:
-            errors.append(f"❌ Question {i}: Invalid line count ({len(lines)})")
-            continue
-            
-        # Process lines
-        question = lines[0].strip()
-        options = [line.strip() for line in lines[1:5]]
-        answer_line = lines[5].strip()
-        
-        # Answer validation
-        if not answer_line.lower().startswith('answer:'):
-            errors.append(f"❌ Q{i}: Missing 'Answer:' prefix")
+
+        match = QUIZ_BLOCK_RE.match(block)
+        if not match:
+            # Classify the failure the way the old line-by-line parser did
+            lines = block.split('\n')
+            if len(lines) < 6 or len(lines) > 7:
+                errors.append(f"❌ Question {i}: Invalid line count ({len(lines)})")
+            elif not lines[5].strip().lower().startswith('answer:'):
+                errors.append(f"❌ Q{i}: Missing 'Answer:' prefix")
+            else:
+                errors.append(f"❌ Q{i}: Malformed answer line")
             continue
-            
-        try:
-            answer_num = int(answer_line.split(':', 1)[1].strip())
-            if not 1 <= answer_num <= 4:
-                errors.append(f"❌ Q{i}: Invalid answer number {answer_num}")
-                continue
-        except (ValueError, IndexError):
-            errors.append(f"❌ Q{i}: Malformed answer line")
+
+        answer_num = int(match.group('answer'))
+        if not 1 <= answer_num <= 4:
+            errors.append(f"❌ Q{i}: Invalid answer number {answer_num}")
             continue
-            
-        explanation = lines[6].strip() if len(lines) > 6 else None
-        valid_questions.append((question, options, answer_num - 1, explanation))
-    
+
+        valid_questions.append((
+            match.group('question'),
+            [match.group('o1'), match.group('o2'), match.group('o3'), match.group('o4')],
+            answer_num - 1,
+            match.group('explanation')
+        ))
+
     return valid_questions, errors
 
+@gated
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user = update.effective_user
     user_id = user.id
@@ -526,15 +797,18 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     # Check if user is premium
     is_prem = await is_premium(user_id)
-    
+
+    # One timestamp per upload; reused for the limit check and count update
+    today = datetime.utcnow().date()
+
     # For token users, check daily quiz limit (20 quizzes)
     if not is_prem:
-        # Get today's date
-        today = datetime.utcnow().date()
-        
         # Check if user has exceeded daily limit
         if DB is not None:
-            user_data = await DB.users.find_one({"user_id": user_id})
+            user_data = await DB.users.find_one(
+                {"user_id": user_id},
+                {"_id": 0, "last_quiz_date": 1, "quiz_count": 1}
+            )
             if user_data:
                 last_quiz_date = user_data.get("last_quiz_date")
                 quiz_count = user_data.get("quiz_count", 0)
@@ -560,11 +834,17 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     try:
         # Download directly to memory
         file = await context.bot.get_file(update.message.document.file_id)
-        content = await file.download_as_bytearray()
-        content = content.decode('utf-8')
+        buffer = io.BytesIO()
+        await file.download_to_memory(buffer)
+        content = buffer.getvalue().decode('utf-8')
+        # Normalize line endings once so \r never leaks into options or
+        # trips the block regex
+        content = content.replace('\r\n', '\n').replace('\r', '\n')
         
         # Parse and validate
-        valid_questions, errors = parse_quiz_file(content)
+        # Parse off the event loop so a multi-MB file doesn't stall
+        # every other user's updates
+        valid_questions, errors = await asyncio.to_thread(parse_quiz_file, content)
         
         # Report errors
         if errors:
@@ -581,46 +861,60 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 f"✅ Sending {len(valid_questions)} quiz question(s)..."
             )
             
+            # Send polls concurrently; the semaphore keeps us inside
+            # Telegram's rate limits without a fixed per-send sleep
+            send_semaphore = asyncio.Semaphore(20)
+
+            async def send_one(question, options, correct_id, explanation):
+                poll_params = {
+                    "chat_id": update.effective_chat.id,
+                    "question": question,
+                    "options": options,
+                    "type": 'quiz',
+                    "correct_option_id": correct_id,
+                    "is_anonymous": False,
+                    "open_period": 10
+                }
+
+                if explanation:
+                    poll_params["explanation"] = explanation
+
+                async with send_semaphore:
+                    try:
+                        await context.bot.send_poll(**poll_params)
+                        return True
+                    except RetryAfter as e:
+                        # Handle flood control, then retry once
+                        wait_time = e.retry_after + 1
+                        logger.warning(f"Rate limited. Waiting {wait_time} seconds")
+                        await asyncio.sleep(wait_time)
+                        try:
+                            await context.bot.send_poll(**poll_params)
+                            return True
+                        except Exception as e:
+                            logger.error(f"Poll creation error: {str(e)}")
+                    except Exception as e:
+                        logger.error(f"Poll creation error: {str(e)}")
+                    return False
+
             sent_count = 0
-            for question, options, correct_id, explanation in valid_questions:
-                try:
-                    poll_params = {
-                        "chat_id": update.effective_chat.id,
-                        "question": question,
-                        "options": options,
-                        "type": 'quiz',
-                        "correct_option_id": correct_id,
-                        "is_anonymous": False,
-                        "open_period": 10
-                    }
-                    
-                    if explanation:
-                        poll_params["explanation"] = explanation
-                    
-                    await context.bot.send_poll(**poll_params)
+            completed = 0
+            last_progress = time.monotonic()
+            for future in asyncio.as_completed([send_one(*q) for q in valid_questions]):
+                if await future:
                     sent_count += 1
-                    
-                    # Update progress every 5 questions
-                    if sent_count % 5 == 0:
-                        await msg.edit_text(
-                            f"✅ Sent {sent_count}/{len(valid_questions)} questions..."
-                        )
-                    
-                    # Rate limit: 20 messages per second (Telegram limit)
-                    await asyncio.sleep(0.05)
-                    
-                except RetryAfter as e:
-                    # Handle flood control
-                    wait_time = e.retry_after + 1
-                    logger.warning(f"Rate limited. Waiting {wait_time} seconds")
-                    await asyncio.sleep(wait_time)
-                    continue
-                except Exception as e:
-                    logger.error(f"Poll creation error: {str(e)}")
+                completed += 1
+
+                # Throttle progress edits to about one per second
+                now = time.monotonic()
+                if now - last_progress >= 1.0 and completed < len(valid_questions):
+                    last_progress = now
+                    await msg.edit_text(
+                        f"✅ Sent {sent_count}/{len(valid_questions)} questions..."
+                    )
             
             # Update quiz count for token users
             if not is_prem and DB is not None:
-                today = datetime.utcnow().date()
                 await DB.users.update_one(
                     {"user_id": user_id},
                     {
@@ -640,37 +934,37 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         logger.error(f"File processing error: {str(e)}")
         await update.message.reply_text("⚠️ Error processing file. Please try again.")
 
+@gated
+@requires_db("⚠️ Database connection error. Stats unavailable.")
 async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await record_user_interaction(update)
     
     # Check if user is owner
-    owner_id = os.getenv('OWNER_ID')
-    if not owner_id or str(update.effective_user.id) != owner_id:
+    if update.effective_user.id != OWNER_ID:
         await update.message.reply_text("🚫 This command is only available to the bot owner.")
         return
 
-    # Check if DB is initialized (not None)
-    if DB is None:
-        await update.message.reply_text("⚠️ Database connection error. Stats unavailable.")
-        return
-        
     try:
-        # Calculate stats concurrently
+        # Calculate stats concurrently; estimated counts read collection
+        # metadata instead of scanning, which is plenty for a stats display
         tasks = [
-            DB.users.count_documents({}),
-            DB.tokens.count_documents({}),
-            DB.sudo_users.count_documents({}),
-            DB.premium_users.count_documents({})
+            DB.users.estimated_document_count(),
+            DB.tokens.estimated_document_count(),
+            DB.sudo_users.estimated_document_count(),
+            DB.premium_users.estimated_document_count()
         ]
         total_users, active_tokens, sudo_count, premium_count = await asyncio.gather(*tasks)
-        
-        # Ping calculation
-        start_time = time.time()
+
+        # Ping calculation: time an actual DB round trip rather than a
+        # Telegram API call
+        start_time = time.perf_counter()
+        await DB.command('ping')
+        ping_time = (time.perf_counter() - start_time) * 1000
+
         ping_msg = await update.message.reply_text("🏓 Pong!")
-        ping_time = (time.time() - start_time) * 1000
         
         # Uptime calculation
-        uptime_seconds = int(time.time() - bot_start_time)
+        uptime_seconds = int(time.monotonic() - bot_start_time)
         uptime = str(timedelta(seconds=uptime_seconds))
         
         # Format stats message
@@ -696,8 +990,7 @@ async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 # Broadcast commands
 async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # Check if user is owner
-    owner_id = os.getenv('OWNER_ID')
-    if not owner_id or str(update.effective_user.id) != owner_id:
+    if update.effective_user.id != OWNER_ID:
         await update.message.reply_text("🚫 This command is only available to the bot owner.")
         return
         
@@ -714,10 +1007,10 @@ async def broadcast_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         parse_mode='HTML'
     )
 
+@requires_db("⚠️ Database connection error. Broadcast failed.")
 async def confirm_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # Check if user is owner
-    owner_id = os.getenv('OWNER_ID')
-    if not owner_id or str(update.effective_user.id) != owner_id:
+    if update.effective_user.id != OWNER_ID:
         await update.message.reply_text("🚫 This command is only available to the bot owner.")
         return
         
@@ -731,11 +1024,6 @@ async def confirm_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await update.message.reply_text("⚠️ No broadcast message found. Please try again.")
         return
         
-    # Get all users from DB
-    if DB is None:
-        await update.message.reply_text("⚠️ Database connection error. Broadcast failed.")
-        return
-        
     try:
         total_users = await DB.users.count_documents({})
         if total_users == 0:
@@ -747,81 +1035,124 @@ async def confirm_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE)
             "Sent: 0 | Failed: 0"
         )
         
-        users = DB.users.find({})
+        # Only the id is needed; project it and pull large batches per round-trip
+        users = DB.users.find({}, {"user_id": 1, "_id": 0}).batch_size(1000)
         sent_count = 0
         failed_count = 0
-        
+
+        # Keep only the last few failure details for the report; the full
+        # count lives in failed_count
+        failed_details = deque(maxlen=5)
+
+        # Cap concurrency to respect Telegram rate limits (30 messages/second)
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+
+        async def send_to_user(user_id):
+            async with semaphore:
+                try:
+                    if broadcast_data['type'] == 'text':
+                        await context.bot.send_message(
+                            chat_id=user_id,
+                            text=broadcast_data['content'],
+                            parse_mode=broadcast_data.get('parse_mode', None)
+                        )
+                    elif broadcast_data['type'] == 'photo':
+                        await context.bot.send_photo(
+                            chat_id=user_id,
+                            photo=broadcast_data['content'],
+                            caption=broadcast_data.get('caption', ''),
+                            parse_mode=broadcast_data.get('parse_mode', None)
+                        )
+                    elif broadcast_data['type'] == 'video':
+                        await context.bot.send_video(
+                            chat_id=user_id,
+                            video=broadcast_data['content'],
+                            caption=broadcast_data.get('caption', ''),
+                            parse_mode=broadcast_data.get('parse_mode', None)
+                        )
+                    elif broadcast_data['type'] == 'document':
+                        await context.bot.send_document(
+                            chat_id=user_id,
+                            document=broadcast_data['content'],
+                            caption=broadcast_data.get('caption', ''),
+                            parse_mode=broadcast_data.get('parse_mode', None)
+                        )
+                    elif broadcast_data['type'] == 'sticker':
+                        await context.bot.send_sticker(
+                            chat_id=user_id,
+                            sticker=broadcast_data['content']
+                        )
+                    else:
+                        # Fallback to text
+                        await context.bot.send_message(
+                            chat_id=user_id,
+                            text="📢 New broadcast from admin!",
+                            parse_mode='HTML'
+                        )
+
+                    return True, None
+
+                except RetryAfter as e:
+                    # Handle flood control
+                    wait_time = e.retry_after + 1
+                    logger.warning(f"Rate limited. Waiting {wait_time} seconds")
+                    await asyncio.sleep(wait_time)
+                    return False, f"{user_id}: flood wait"
+                except Exception as e:
+                    logger.error(f"Broadcast failed to {user_id}: {str(e)}")
+                    return False, f"{user_id}: {e}"
+
+        # Each task reports (ok, err); counters are summed once per batch
+        # instead of being mutated from inside every coroutine
+        async def run_batch(user_ids):
+            nonlocal sent_count, failed_count
+            results = await asyncio.gather(*(send_to_user(uid) for uid in user_ids))
+            ok_count = sum(1 for ok, _ in results if ok)
+            sent_count += ok_count
+            failed_count += len(results) - ok_count
+            failed_details.extend(err for ok, err in results if not ok and err)
+            return any(err and 'flood' in err for _, err in results)
+
+        # Fan out in concurrent batches instead of one sequential await per user
+        batch = []
+        delay = 0.1
+        last_edit = time.monotonic()
         async for user in users:
-            try:
-                if broadcast_data['type'] == 'text':
-                    await context.bot.send_message(
-                        chat_id=user['user_id'],
-                        text=broadcast_data['content'],
-                        parse_mode=broadcast_data.get('parse_mode', None)
-                    )
-                elif broadcast_data['type'] == 'photo':
-                    await context.bot.send_photo(
-                        chat_id=user['user_id'],
-                        photo=broadcast_data['content'],
-                        caption=broadcast_data.get('caption', ''),
-                        parse_mode=broadcast_data.get('parse_mode', None)
-                    )
-                elif broadcast_data['type'] == 'video':
-                    await context.bot.send_video(
-                        chat_id=user['user_id'],
-                        video=broadcast_data['content'],
-                        caption=broadcast_data.get('caption', ''),
-                        parse_mode=broadcast_data.get('parse_mode', None)
-                    )
-                elif broadcast_data['type'] == 'document':
-                    await context.bot.send_document(
-                        chat_id=user['user_id'],
-                        document=broadcast_data['content'],
-                        caption=broadcast_data.get('caption', ''),
-                        parse_mode=broadcast_data.get('parse_mode', None)
-                    )
-                elif broadcast_data['type'] == 'sticker':
-                    await context.bot.send_sticker(
-                        chat_id=user['user_id'],
-                        sticker=broadcast_data['content']
-                    )
+            batch.append(user['user_id'])
+            if len(batch) >= 100:
+                flooded = await run_batch(batch)
+                batch = []
+
+                # AIMD pacing: double the inter-batch delay after a flood
+                # wait, halve it away again while batches run clean
+                if flooded:
+                    delay = min(delay * 2, 2.0)
                 else:
-                    # Fallback to text
-                    await context.bot.send_message(
-                        chat_id=user['user_id'],
-                        text="📢 New broadcast from admin!",
-                        parse_mode='HTML'
-                    )
-                
-                sent_count += 1
-                
-                # Update progress every 20 messages
-                if sent_count % 20 == 0:
+                    delay = delay * 0.5
+                if delay > 0.01:
+                    await asyncio.sleep(delay)
+
+                # Progress edits are Telegram calls too; at most one per 3s
+                if time.monotonic() - last_edit > 3.0:
+                    last_edit = time.monotonic()
                     await progress_msg.edit_text(
-                        f"📤 Broadcasting to {total_users} users...\n"
-                        f"Sent: {sent_count} | Failed: {failed_count}"
+                        BROADCAST_PROGRESS_TEMPLATE.format(
+                            total=total_users, sent=sent_count, failed=failed_count
+                        )
                     )
-                
-                # Respect Telegram rate limits (30 messages/second)
-                await asyncio.sleep(0.1)
-                    
-            except Exception as e:
-                logger.error(f"Broadcast failed to {user['user_id']}: {str(e)}")
-                failed_count += 1
-                
-                # If we get rate limited, wait longer
-                if "RetryAfter" in str(e):
-                    wait_time = 5
-                    logger.warning(f"Rate limited. Waiting {wait_time} seconds")
-                    await asyncio.sleep(wait_time)
+        if batch:
+            await run_batch(batch)
         
         # Final update
-        await progress_msg.edit_text(
+        report_text = (
             f"✅ Broadcast completed!\n"
             f"• Total users: {total_users}\n"
             f"• Sent successfully: {sent_count}\n"
             f"• Failed: {failed_count}"
         )
+        if failed_details:
+            report_text += "\n\nRecent failures:\n" + "\n".join(failed_details)
+        await progress_msg.edit_text(report_text)
         
         # Clean up broadcast state
         if user_id in BROADCAST_STATE:
@@ -833,8 +1164,7 @@ async def confirm_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def cancel_broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # Check if user is owner
-    owner_id = os.getenv('OWNER_ID')
-    if not owner_id or str(update.effective_user.id) != owner_id:
+    if update.effective_user.id != OWNER_ID:
         await update.message.reply_text("🚫 This command is only available to the bot owner.")
         return
         
@@ -851,33 +1181,29 @@ async def handle_broadcast_message(update: Update, context: ContextTypes.DEFAULT
         return
         
     # Process different message types
+    message = update.message
     broadcast_data = {}
-    
-    if update.message.text:
+
+    if message.text:
         broadcast_data['type'] = 'text'
-        broadcast_data['content'] = update.message.text_html if update.message.text_html else update.message.text
-        broadcast_data['parse_mode'] = 'HTML'
-    elif update.message.photo:
-        broadcast_data['type'] = 'photo'
-        broadcast_data['content'] = update.message.photo[-1].file_id  # Highest resolution
-        broadcast_data['caption'] = update.message.caption_html if update.message.caption_html else update.message.caption
-        broadcast_data['parse_mode'] = 'HTML'
-    elif update.message.video:
-        broadcast_data['type'] = 'video'
-        broadcast_data['content'] = update.message.video.file_id
-        broadcast_data['caption'] = update.message.caption_html if update.message.caption_html else update.message.caption
+        broadcast_data['content'] = message.text_html if message.text_html else message.text
         broadcast_data['parse_mode'] = 'HTML'
-    elif update.message.document:
-        broadcast_data['type'] = 'document'
-        broadcast_data['content'] = update.message.document.file_id
-        broadcast_data['caption'] = update.message.caption_html if update.message.caption_html else update.message.caption
-        broadcast_data['parse_mode'] = 'HTML'
-    elif update.message.sticker:
+    elif message.sticker:
         broadcast_data['type'] = 'sticker'
-        broadcast_data['content'] = update.message.sticker.file_id
+        broadcast_data['content'] = message.sticker.file_id
     else:
-        await update.message.reply_text("⚠️ Unsupported message type for broadcast. Please send text or media.")
-        return
+        # Captioned media kinds share the same shape; dispatch via table
+        # instead of one branch per type
+        for attr, get_file_id in BROADCAST_MEDIA_KINDS:
+            if getattr(message, attr):
+                broadcast_data['type'] = attr
+                broadcast_data['content'] = get_file_id(message)
+                broadcast_data['caption'] = message.caption_html if message.caption_html else message.caption
+                broadcast_data['parse_mode'] = 'HTML'
+                break
+        else:
+            await update.message.reply_text("⚠️ Unsupported message type for broadcast. Please send text or media.")
+            return
         
     # Save broadcast message and update state
     BROADCAST_STATE[user_id] = {
@@ -912,8 +1238,7 @@ async def add_premium(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     await record_user_interaction(update)
     
     # Verify owner
-    owner_id = os.getenv('OWNER_ID')
-    if not owner_id or str(update.effective_user.id) != owner_id:
+    if update.effective_user.id != OWNER_ID:
         await update.message.reply_text("🚫 This command is only available to the bot owner.")
         return
         
@@ -948,32 +1273,37 @@ async def add_premium(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             target_user_id = int(user_ref)
             # Try to get user from database
             if DB is not None:
-                user_data = await DB.users.find_one({"user_id": target_user_id})
+                user_data = await DB.users.find_one(
+                    {"user_id": target_user_id},
+                    {"_id": 0, "first_name": 1, "last_name": 1}
+                )
                 if user_data:
                     target_fullname = f"{user_data.get('first_name', '')} {user_data.get('last_name', '')}".strip()
         except ValueError:
             # Not an integer, treat as username
             username = user_ref.lstrip('@')
-            if DB is not None:
-                user_data = await DB.users.find_one({"username": username})
+            resolved = USERNAME_CACHE.get(username)
+            if resolved is None and DB is not None:
+                user_data = await DB.users.find_one(
+                    {"username": username},
+                    {"_id": 0, "user_id": 1, "first_name": 1, "last_name": 1}
+                )
                 if user_data:
-                    target_user_id = user_data["user_id"]
-                    target_fullname = f"{user_data.get('first_name', '')} {user_data.get('last_name', '')}".strip()
+                    resolved = (
+                        user_data["user_id"],
+                        f"{user_data.get('first_name', '')} {user_data.get('last_name', '')}".strip()
+                    )
+                    USERNAME_CACHE[username] = resolved
+            if resolved:
+                target_user_id, target_fullname = resolved
     
     # Get duration
     duration_str = context.args[-1].lower()
-    duration_map = {
-        "1hr": timedelta(hours=1),
-        "1day": timedelta(days=1),
-        "1month": timedelta(days=30),
-        "1year": timedelta(days=365)
-    }
-    
-    if duration_str not in duration_map:
+    if duration_str not in DURATION_MAP:
         await update.message.reply_text("❌ Invalid duration. Use: 1hr, 1day, 1month, 1year")
         return
-    
-    duration = duration_map[duration_str]
+
+    duration = DURATION_MAP[duration_str]
     
     if target_user_id is None:
         await update.message.reply_text("❌ User not found. Please make sure the user has interacted with the bot.")
@@ -995,16 +1325,19 @@ async def add_premium(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
                 "full_name": target_fullname,
                 "start_date": now,
                 "expiry_date": expiry_date,
+                # Epoch seconds so is_premium compares numbers instead
+                # of building a datetime per check
+                "expiry_ts": int(expiry_date.replace(tzinfo=timezone.utc).timestamp()),
                 "added_by": update.effective_user.id,
                 "plan": duration_str
             }},
             upsert=True
         )
         
-        # Clear premium cache
-        if target_user_id in PREMIUM_CACHE:
-            del PREMIUM_CACHE[target_user_id]
-        
+        # Clear premium caches
+        PREMIUM_CACHE.pop(target_user_id, None)
+        PLAN_RENDER_CACHE.pop(target_user_id, None)
+
         # Send message to premium user
         try:
             await context.bot.send_message(
@@ -1038,8 +1371,7 @@ async def remove_premium(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await record_user_interaction(update)
     
     # Verify owner
-    owner_id = os.getenv('OWNER_ID')
-    if not owner_id or str(update.effective_user.id) != owner_id:
+    if update.effective_user.id != OWNER_ID:
         await update.message.reply_text("🚫 This command is only available to the bot owner.")
         return
         
@@ -1058,7 +1390,10 @@ async def remove_premium(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             # Treat as username
             username = context.args[0].lstrip('@')
             if DB is not None:
-                user_data = await DB.users.find_one({"username": username})
+                user_data = await DB.users.find_one(
+                    {"username": username},
+                    {"_id": 0, "user_id": 1}
+                )
                 if user_data:
                     target_user_id = user_data["user_id"]
     
@@ -1071,10 +1406,10 @@ async def remove_premium(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         result = await DB.premium_users.delete_one({"user_id": target_user_id})
         
         if result.deleted_count > 0:
-            # Clear premium cache
-            if target_user_id in PREMIUM_CACHE:
-                del PREMIUM_CACHE[target_user_id]
-            
+            # Clear premium caches
+            PREMIUM_CACHE.pop(target_user_id, None)
+            PLAN_RENDER_CACHE.pop(target_user_id, None)
+
             await update.message.reply_text(
                 f"✅ Premium access removed for user ID: `{target_user_id}`",
                 parse_mode='Markdown'
@@ -1084,51 +1419,59 @@ async def remove_premium(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     else:
         await update.message.reply_text("⚠️ Database error. Premium not removed.")
 
+@requires_db("⚠️ Database connection error.")
 async def list_premium(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await record_user_interaction(update)
     
     # Verify owner
-    owner_id = os.getenv('OWNER_ID')
-    if not owner_id or str(update.effective_user.id) != owner_id:
+    if update.effective_user.id != OWNER_ID:
         await update.message.reply_text("🚫 This command is only available to the bot owner.")
         return
-        
-    if DB is None:
-        await update.message.reply_text("⚠️ Database connection error.")
-        return
-    
+
     try:
-        # Get all premium users
-        premium_users = []
-        async for user in DB.premium_users.find({}):
-            premium_users.append(user)
-        
+        # Pull the whole result set in one batch, fetching only the
+        # fields the listing renders
+        premium_users = await DB.premium_users.find(
+            {},
+            projection={
+                "_id": 0,
+                "user_id": 1,
+                "full_name": 1,
+                "plan": 1,
+                "start_date": 1,
+                "expiry_date": 1
+            }
+        ).to_list(length=None)
+
+
         if not premium_users:
             await update.message.reply_text("ℹ️ No premium users found.")
             return
             
-        response = "🌟 *Premium Users List* 🌟\n\n"
-        
+        parts = ["🌟 *Premium Users List* 🌟\n"]
+
         for user in premium_users:
-            user_id = user["user_id"]
-            full_name = user.get("full_name", "Unknown")
-            plan = user.get("plan", "Unknown")
-            start_date = format_ist(user["start_date"])
-            expiry_date = format_ist(user["expiry_date"])
-            
-            response += (
-                f"👤 *User*: {full_name}\n"
-                f"🆔 *ID*: `{user_id}`\n"
-                f"📦 *Plan*: {plan}\n"
-                f"⏱️ *Start*: {start_date} IST\n"
-                f"⏳ *Expiry*: {expiry_date} IST\n"
-                f"────────────────────\n"
-            )
-        
-        await update.message.reply_text(
-            response,
-            parse_mode='Markdown'
-        )
+            parts.append(PREMIUM_ENTRY_TEMPLATE.format(
+                full_name=user.get("full_name", "Unknown"),
+                user_id=user["user_id"],
+                plan=user.get("plan", "Unknown"),
+                start_date=format_ist(user["start_date"]),
+                expiry_date=format_ist(user["expiry_date"])
+            ))
+
+        # Join once instead of += per user, and split the listing into
+        # messages under Telegram's 4096-char limit
+        chunk = []
+        chunk_len = 0
+        for part in parts:
+            if chunk and chunk_len + len(part) + 1 > 4000:
+                await update.message.reply_text("\n".join(chunk), parse_mode='Markdown')
+                chunk = []
+                chunk_len = 0
+            chunk.append(part)
+            chunk_len += len(part) + 1
+        if chunk:
+            await update.message.reply_text("\n".join(chunk), parse_mode='Markdown')
         
     except Exception as e:
         logger.error(f"Premium list error: {e}")
@@ -1144,7 +1487,7 @@ async def my_plan_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         # Suggest premium plans
         keyboard = [
             [InlineKeyboardButton("💎 Premium Plans", callback_data="premium_plans")],
-            [InlineKeyboardButton("📞 Contact Admin", url=f"https://t.me/{PREMIUM_CONTACT.lstrip('@')}")]
+            [InlineKeyboardButton("📞 Contact Admin", url=f"https://t.me/{PREMIUM_CONTACT_USERNAME}")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
         
@@ -1156,9 +1499,18 @@ async def my_plan_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         return
     
+    # Serve a recent render straight from cache
+    cached_response = PLAN_RENDER_CACHE.get(user_id)
+    if cached_response:
+        await update.message.reply_text(cached_response, parse_mode='Markdown')
+        return
+
     # Get premium details
     if DB is not None:
-        premium_data = await DB.premium_users.find_one({"user_id": user_id})
+        premium_data = await DB.premium_users.find_one(
+            {"user_id": user_id},
+            {"_id": 0, "full_name": 1, "plan": 1, "start_date": 1, "expiry_date": 1}
+        )
         if premium_data:
             # Format dates in IST
             start_date = format_ist(premium_data["start_date"])
@@ -1166,16 +1518,16 @@ async def my_plan_command(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             time_left = format_time_left(premium_data["expiry_date"])
             plan_name = premium_data.get("plan", "Premium")
             
-            response = (
-                "⚜️ ᴘʀᴇᴍɪᴜᴍ ᴜꜱᴇʀ ᴅᴀᴛᴀ :\n\n"
-                f"👤 ᴜꜱᴇʀ : {premium_data.get('full_name', user.full_name)}\n"
-                f"⚡ ᴜꜱᴇʀ ɪᴅ : `{user_id}`\n"
-                f"⏰ ᴘʀᴇᴍɪᴜᴍ ᴘʟᴀɴ : {plan_name}\n\n"
-                f"⏱️ ᴊᴏɪɴɪɴɢ ᴅᴀᴛᴇ : {start_date} IST\n"
-                f"⌛️ ᴇxᴘɪʀʏ ᴅᴀᴛᴇ : {expiry_date} IST\n"
-                f"⏳ ᴛɪᴍᴇ ʟᴇꜰᴛ : {time_left}"
+            response = MY_PLAN_TEMPLATE.format(
+                full_name=premium_data.get('full_name', user.full_name),
+                user_id=user_id,
+                plan_name=plan_name,
+                start_date=start_date,
+                expiry_date=expiry_date,
+                time_left=time_left
             )
-            
+            PLAN_RENDER_CACHE[user_id] = response
+
             await update.message.reply_text(
                 response,
                 parse_mode='Markdown'
@@ -1200,153 +1552,238 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 # Optimized token validation with caching
 async def has_valid_token(user_id):
-    if await is_sudo(user_id) or await is_premium(user_id):
+    # Sudo and premium are independent lookups; overlap them so a cold
+    # cache costs one round-trip of latency instead of two
+    sudo, prem = await asyncio.gather(is_sudo(user_id), is_premium(user_id))
+    if sudo or prem:
         return True
         
     # Check cache first
     cached = TOKEN_CACHE.get(user_id)
-    if cached and time.time() < cached['expiry']:
-        return cached['result']
-        
-    result = False
-    # Check if DB is initialized (not None)
-    if DB is not None:
-        try:
-            token_data = await DB.tokens.find_one({"user_id": user_id})
-            result = token_data is not None
-        except Exception as e:
-            logger.error(f"Token check error: {e}")
-    
-    # Update cache
-    TOKEN_CACHE[user_id] = {
-        'result': result,
-        'expiry': time.time() + CACHE_EXPIRY
-    }
-    return result
+    if cached is not None:
+        return cached
+
+    async with get_user_lock(TOKEN_LOCKS, user_id):
+        # Re-check: another coroutine may have filled the cache while we waited
+        cached = TOKEN_CACHE.get(user_id)
+        if cached is not None:
+            return cached
+
+        result = False
+        # Check if DB is initialized (not None)
+        if DB is not None:
+            try:
+                # The TTL index on expires_at deletes expired tokens, so
+                # presence means validity; the probe stays covered by the
+                # unique user_id index
+                token_data = await DB.tokens.find_one(
+                    {"user_id": user_id},
+                    {"_id": 0, "user_id": 1}
+                )
+                result = token_data is not None
+            except Exception as e:
+                logger.error(f"Token check error: {e}")
+
+        # Update cache
+        TOKEN_CACHE[user_id] = result
+        return result
 
 # Premium check with caching
 async def is_premium(user_id):
     # Check cache first
     cached = PREMIUM_CACHE.get(user_id)
-    if cached and time.time() < cached['expiry']:
-        return cached['result']
-        
-    result = False
-    # Check if DB is initialized (not None)
-    if DB is not None:
-        try:
-            premium_data = await DB.premium_users.find_one({"user_id": user_id})
-            if premium_data:
-                # Check if premium has expired
-                if premium_data["expiry_date"] > datetime.utcnow():
-                    result = True
-                else:
-                    # Remove expired premium
-                    await DB.premium_users.delete_one({"_id": premium_data["_id"]})
-        except Exception as e:
-            logger.error(f"Premium check error: {e}")
-    
-    # Update cache
-    PREMIUM_CACHE[user_id] = {
-        'result': result,
-        'expiry': time.time() + CACHE_EXPIRY
-    }
-    return result
+    if cached is not None:
+        return cached
+
+    async with get_user_lock(PREMIUM_LOCKS, user_id):
+        # Re-check: another coroutine may have filled the cache while we waited
+        cached = PREMIUM_CACHE.get(user_id)
+        if cached is not None:
+            return cached
+
+        result = False
+        # Check if DB is initialized (not None)
+        if DB is not None:
+            try:
+                premium_data = await DB.premium_users.find_one(
+                    {"user_id": user_id},
+                    {"_id": 0, "expiry_ts": 1, "expiry_date": 1}
+                )
+                if premium_data:
+                    # The TTL index purges expired docs server-side; the
+                    # compare only covers the ~minute of sweep lag. Epoch
+                    # compare on expiry_ts; expiry_date covers docs
+                    # written before expiry_ts existed
+                    expiry_ts = premium_data.get("expiry_ts")
+                    if expiry_ts is not None:
+                        result = expiry_ts > time.time()
+                    else:
+                        result = premium_data["expiry_date"] > datetime.utcnow()
+            except Exception as e:
+                logger.error(f"Premium check error: {e}")
+
+        # Update cache
+        PREMIUM_CACHE[user_id] = result
+        return result
+
+# Handler table, built once at import and registered in bulk. Order
+# matters: the document handler must come before the catch-all
+# broadcast message handler.
+HANDLERS = (
+    CommandHandler("start", start_wrapper),
+    CommandHandler("help", help_command),
+    CommandHandler("createquiz", create_quiz),
+    CommandHandler("stats", stats_command),
+    CommandHandler("token", token_command),
+    CommandHandler("plan", plan_command),
+    CommandHandler("myplan", my_plan_command),
+    MessageHandler(filters.Document.TEXT, handle_document),
+    CommandHandler("broadcast", broadcast_command),
+    CommandHandler("confirm_broadcast", confirm_broadcast),
+    CommandHandler("cancel_broadcast", cancel_broadcast),
+    MessageHandler(filters.ALL & ~filters.COMMAND, handle_broadcast_message),
+    CommandHandler("add", add_premium),
+    CommandHandler("rem", remove_premium),
+    CommandHandler("premium", list_premium),
+    CallbackQueryHandler(button_handler, pattern=BUTTON_CB_PATTERN),
+)
 
 async def main_async() -> None:
     """Async main function"""
     global DB, SESSION
-    
+
+    # Create the shared HTTP session before any handler can need it
+    init_session()
+
+    # Serve health checks from this loop instead of a Flask thread; in
+    # webhook mode the webhook server owns PORT and answers liveness itself
+    health_runner = None
+    if not WEBHOOK_URL:
+        health_runner = await start_health_server()
+
     # Initialize database
     DB = await init_db()
     
     # Only proceed if DB initialization was successful (DB is not None)
     if DB is not None:
         await asyncio.gather(
-            create_ttl_index(),
-            create_sudo_index(),
-            create_premium_index()
+            create_db_indexes(),
+            refresh_sudo_ids()
         )
     
-    # Get token from environment
-    TOKEN = os.getenv('TELEGRAM_TOKEN')
-    if not TOKEN:
+    if not TELEGRAM_TOKEN:
         logger.error("No TELEGRAM_TOKEN found in environment!")
         return
+
+    # Create Telegram application; HTTP/2 multiplexes concurrent sends
+    # (polls, broadcasts) over one TLS connection
+    application = (
+        ApplicationBuilder()
+        .token(TELEGRAM_TOKEN)
+        .request(HTTPXRequest(
+            http_version="2",
+            connection_pool_size=64,
+            pool_timeout=10.0
+        ))
+        .get_updates_request(HTTPXRequest(http_version="2"))
+        .build()
+    )
     
-    # Create Telegram application
-    application = ApplicationBuilder().token(TOKEN).pool_timeout(30).build()
-    
-    # Add handlers
-    application.add_handler(CommandHandler("start", start_wrapper))
-    application.add_handler(CommandHandler("help", help_command_wrapper))
-    application.add_handler(CommandHandler("createquiz", create_quiz_wrapper))
-    application.add_handler(CommandHandler("stats", stats_command_wrapper))
-    application.add_handler(CommandHandler("token", token_command))
-    application.add_handler(CommandHandler("plan", plan_command))
-    application.add_handler(CommandHandler("myplan", my_plan_command))
-    application.add_handler(MessageHandler(filters.Document.TEXT, handle_document_wrapper))
-    
-    # Add broadcast commands
-    application.add_handler(CommandHandler("broadcast", broadcast_command))
-    application.add_handler(CommandHandler("confirm_broadcast", confirm_broadcast))
-    application.add_handler(CommandHandler("cancel_broadcast", cancel_broadcast))
-    application.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND, handle_broadcast_message))
-    
-    # Add premium management commands
-    application.add_handler(CommandHandler("add", add_premium))
-    application.add_handler(CommandHandler("rem", remove_premium))
-    application.add_handler(CommandHandler("premium", list_premium))
-    
-    # Add button handler
-    application.add_handler(CallbackQueryHandler(button_handler))
+    # Register the precomputed handler table in one call
+    application.add_handlers(list(HANDLERS))
+    # Runs before every other group so the offset tracks every update
+    application.add_handler(TypeHandler(Update, track_update_id), group=-1)
     
-    # Start polling
-    logger.info("Starting Telegram bot in polling mode...")
+    # Start the background write flusher
+    flusher_task = asyncio.create_task(flush_loop())
+
     try:
         await application.initialize()
+
+        # Acknowledge updates handled before the last shutdown so a
+        # crash-restart doesn't replay up to 24h of old traffic
+        if not WEBHOOK_URL and DB is not None:
+            try:
+                offset_doc = await DB.meta.find_one({"_id": "polling_offset"})
+                if offset_doc:
+                    await application.bot.get_updates(
+                        offset=offset_doc["update_id"] + 1, timeout=0
+                    )
+            except Exception as e:
+                logger.error(f"Error restoring polling offset: {e}")
+
         await application.start()
-        await application.updater.start_polling(
-            poll_interval=0.1,
-            timeout=10,
-            read_timeout=10
-        )
+        if WEBHOOK_URL:
+            # Webhook mode: Telegram pushes updates instead of the bot
+            # holding long-poll connections open
+            logger.info("Starting Telegram bot in webhook mode...")
+            await application.updater.start_webhook(
+                listen="0.0.0.0",
+                port=PORT,
+                url_path=TELEGRAM_TOKEN,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{TELEGRAM_TOKEN}",
+                allowed_updates=["message", "callback_query"]
+            )
+        else:
+            logger.info("Starting Telegram bot in polling mode...")
+            # Real long polling: hold getUpdates open for 50s and re-issue
+            # immediately, instead of hammering every 100ms
+            await application.updater.start_polling(
+                poll_interval=0.0,
+                timeout=50,
+                read_timeout=55,
+                connect_timeout=10,
+                bootstrap_retries=-1,
+                # Only the update types this bot handles; everything else
+                # is dropped server-side
+                allowed_updates=["message", "callback_query"]
+            )
         logger.info("Bot is now running")
-        
-        # Keep running until interrupted
-        while True:
-            await asyncio.sleep(3600)
-            
+
+        # Block until SIGINT/SIGTERM instead of waking hourly for nothing
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop_event.set)
+            except NotImplementedError:
+                # Platforms without signal handler support fall back to
+                # KeyboardInterrupt propagation
+                pass
+        await stop_event.wait()
+
     except asyncio.CancelledError:
         pass
     except Exception as e:
         logger.critical(f"Telegram bot failed: {e}")
     finally:
         # Cleanup
+        flusher_task.cancel()
+        await flush_user_writes()
         if SESSION:
             await SESSION.close()
         if MONGO_CLIENT:
-            MONGO_CLIENT.close()
+            await MONGO_CLIENT.close()
+        if health_runner:
+            await health_runner.cleanup()
         await application.stop()
         logger.info("Bot stopped gracefully")
 
 def main() -> None:
-    """Run the bot and HTTP server"""
-    # Start Flask server in a daemon thread
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-    logger.info(f"Flask server started in separate thread")
-    
-    # Run async main
-    try:
-        asyncio.run(main_async())
-    except KeyboardInterrupt:
-        logger.info("Bot stopped by user")
-    except Exception as e:
-        logger.critical(f"Fatal error: {e}")
-        # Attempt to restart after delay
-        time.sleep(10)
-        main()
+    """Run the bot under a supervisor loop"""
+    backoff = 10
+    while True:
+        try:
+            asyncio.run(main_async())
+            return
+        except KeyboardInterrupt:
+            logger.info("Bot stopped by user")
+            return
+        except Exception as e:
+            logger.critical(f"Fatal error: {e}")
+            # Restart with exponential backoff instead of recursing
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 300)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file